@@ -0,0 +1,121 @@
+# cython: language_level=3
+"""
+Compiled fragment sender for video_udp_streamer.py.
+
+Splits a frame into fragment datagrams and hands them to sendmmsg() without
+holding the GIL, so the encoder callback and the command server keep running
+while a frame goes out. Linux only. See setup.py for how to build it.
+"""
+
+import os
+
+from cpython.mem cimport PyMem_Free, PyMem_Malloc
+from libc.errno cimport errno
+from libc.stdint cimport uint16_t, uint32_t
+from libc.string cimport memset
+
+
+cdef extern from "<arpa/inet.h>" nogil:
+    uint32_t htonl(uint32_t hostlong)
+    uint16_t htons(uint16_t hostshort)
+
+cdef extern from "<sys/uio.h>" nogil:
+    struct iovec:
+        void *iov_base
+        size_t iov_len
+
+cdef extern from "<sys/socket.h>" nogil:
+    struct msghdr:
+        void *msg_name
+        unsigned int msg_namelen
+        iovec *msg_iov
+        size_t msg_iovlen
+        void *msg_control
+        size_t msg_controllen
+        int msg_flags
+
+    struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+
+    int sendmmsg(int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags)
+
+
+# Matches FRAGMENT_HEADER ('!IHH') in video_udp_streamer.py
+cdef packed struct fragment_header:
+    uint32_t frame_id
+    uint16_t index
+    uint16_t count
+
+cdef enum:
+    STACK_BATCH = 64     # Frames of up to this many fragments are sent from arrays on the stack
+    SENDMMSG_MAX = 1024  # Most datagrams the kernel accepts in one sendmmsg call (UIO_MAXIOV)
+
+
+def send_frame(int fd, const unsigned char[::1] frame, uint32_t frame_id, Py_ssize_t payload_size, int flags=0):
+    """
+    Sends a frame on the connected socket fd as datagrams of a fragment header
+    followed by up to payload_size bytes of the frame.
+    """
+    cdef Py_ssize_t size = frame.shape[0]
+    cdef Py_ssize_t count = (size + payload_size - 1) // payload_size
+    if size == 0:
+        return
+    if count > 0xFFFF:
+        raise ValueError("Frame needs more than 65535 fragments")
+
+    cdef const unsigned char *data = &frame[0]
+    cdef Py_ssize_t batch = min(count, <Py_ssize_t>SENDMMSG_MAX)
+    cdef fragment_header stack_headers[STACK_BATCH]
+    cdef iovec stack_iovs[2 * STACK_BATCH]
+    cdef mmsghdr stack_msgs[STACK_BATCH]
+    cdef fragment_header *headers = stack_headers
+    cdef iovec *iovs = stack_iovs
+    cdef mmsghdr *msgs = stack_msgs
+    cdef Py_ssize_t start = 0, offset, i, n
+    cdef int sent, err = 0
+
+    if batch > STACK_BATCH:
+        # Larger frames still go out in a single call, from arrays on the heap
+        headers = <fragment_header *>PyMem_Malloc(batch * sizeof(fragment_header))
+        iovs = <iovec *>PyMem_Malloc(2 * batch * sizeof(iovec))
+        msgs = <mmsghdr *>PyMem_Malloc(batch * sizeof(mmsghdr))
+        if headers == NULL or iovs == NULL or msgs == NULL:
+            PyMem_Free(headers)
+            PyMem_Free(iovs)
+            PyMem_Free(msgs)
+            raise MemoryError()
+
+    memset(msgs, 0, batch * sizeof(mmsghdr)) # No address, the socket is connected to the target
+    with nogil:
+        while start < count:
+            n = min(count - start, batch)
+            for i in range(n):
+                headers[i].frame_id = htonl(frame_id)
+                headers[i].index = htons(<uint16_t>(start + i))
+                headers[i].count = htons(<uint16_t>count)
+                offset = (start + i) * payload_size
+                iovs[2 * i].iov_base = &headers[i]
+                iovs[2 * i].iov_len = sizeof(fragment_header)
+                iovs[2 * i + 1].iov_base = <void *>(data + offset)
+                iovs[2 * i + 1].iov_len = min(payload_size, size - offset)
+                msgs[i].msg_hdr.msg_iov = &iovs[2 * i]
+                msgs[i].msg_hdr.msg_iovlen = 2
+
+            i = 0
+            while i < n: # The kernel may accept fewer than asked for
+                sent = sendmmsg(fd, &msgs[i], <unsigned int>(n - i), flags)
+                if sent < 0:
+                    err = errno
+                    break
+                i += sent
+            if err:
+                break
+            start += n
+
+    if headers != stack_headers:
+        PyMem_Free(headers)
+        PyMem_Free(iovs)
+        PyMem_Free(msgs)
+    if err:
+        raise OSError(err, os.strerror(err))
@@ -0,0 +1,46 @@
+cimport cython
+
+cpdef bytes encode_message(dict message)
+cpdef send_message(object sock, dict message)
+
+
+cdef class CommandParser:
+    cdef public object tbot
+    cdef public dict handlers
+    cdef object _hw_executor
+    cdef object _motion_lock
+    cdef tuple _pending_motion
+
+    @cython.locals(speed=cython.double)
+    cpdef bint _h_forward(self, object command, object conn)
+
+    @cython.locals(speed=cython.double)
+    cpdef bint _h_backward(self, object command, object conn)
+
+    @cython.locals(speed=cython.double)
+    cpdef bint _h_turn_left(self, object command, object conn)
+
+    @cython.locals(speed=cython.double)
+    cpdef bint _h_turn_right(self, object command, object conn)
+
+    @cython.locals(left=cython.double, right=cython.double)
+    cpdef bint _h_set_speeds(self, object command, object conn)
+
+    cpdef bint _h_stop(self, object command, object conn)
+    cpdef bint _h_coast(self, object command, object conn)
+
+    @cython.locals(led_id=cython.int, value=cython.double)
+    cpdef bint _h_set_led(self, object command, object conn)
+
+    @cython.locals(r=cython.int, g=cython.int, b=cython.int)
+    cpdef bint _h_fill_underlighting(self, object command, object conn)
+
+    cpdef bint _h_set_underlighting_rgb(self, object command, object conn)
+
+    cpdef bint _h_read_distance(self, object command, object conn)
+    cpdef bint _h_ping(self, object command, object conn)
+    cpdef bint _h_exit(self, object command, object conn)
+
+    cpdef bint dispatch(self, object command, object conn)
+
+    cpdef bint parse(self, bytes payload, object conn)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import logging
+import socket
+import threading
+import concurrent.futures
+from typing import Union
+
+import msgspec
+
+# This module runs as plain Python, but can be compiled with Cython for a faster
+# command hot path. Static types for the compiled build live in command_parser.pxd.
+# See setup.py in this directory for how to build it.
+
+log = logging.getLogger(__name__)
+
+# --- Configuration ---
+HEADER_SIZE = 4       # Big-endian length prefix in front of every message
+MAX_MESSAGE_SIZE = 4096 # Largest message accepted, far above any command or reply. Anything bigger means a broken or foreign peer
+HW_TIMEOUT = 0.5      # Seconds to wait for hardware calls that produce a reply
+
+# --- Command Types ---
+# Commands are decoded straight into these, so fields arrive typed and defaulted.
+# The 'action' key of an incoming map picks the type.
+class _Cmd(msgspec.Struct, tag_field='action'):
+    pass
+
+class ForwardCmd(_Cmd, tag='forward'):
+    speed: float = 1.0
+
+class BackwardCmd(_Cmd, tag='backward'):
+    speed: float = 1.0
+
+class TurnLeftCmd(_Cmd, tag='turn_left'):
+    speed: float = 1.0
+
+class TurnRightCmd(_Cmd, tag='turn_right'):
+    speed: float = 1.0
+
+class SetSpeedsCmd(_Cmd, tag='set_speeds'):
+    left: float = 0.0
+    right: float = 0.0
+
+class StopCmd(_Cmd, tag='stop'):
+    pass
+
+class CoastCmd(_Cmd, tag='coast'):
+    pass
+
+class SetLedCmd(_Cmd, tag='set_led'):
+    led: int
+    value: float
+
+class FillUnderlightingCmd(_Cmd, tag='fill_underlighting'):
+    r: int = 0
+    g: int = 0
+    b: int = 0
+
+class SetUnderlightingRgbCmd(_Cmd, tag='set_underlighting_rgb'):
+    data: bytes # R, G, B for each underlight in turn
+
+class ReadDistanceCmd(_Cmd, tag='read_distance'):
+    pass
+
+class PingCmd(_Cmd, tag='ping'):
+    pass
+
+class ExitCmd(_Cmd, tag='exit'):
+    pass
+
+Command = Union[ForwardCmd, BackwardCmd, TurnLeftCmd, TurnRightCmd, SetSpeedsCmd, StopCmd, CoastCmd,
+                SetLedCmd, FillUnderlightingCmd, SetUnderlightingRgbCmd, ReadDistanceCmd, PingCmd, ExitCmd]
+
+# --- Wire Protocol ---
+# Each message is a msgpack-encoded map preceded by its length as a 4-byte big-endian integer.
+# Shared with trilobot_client.py, which imports it from here.
+enc = msgspec.msgpack.Encoder()
+dec = msgspec.msgpack.Decoder(Command)
+
+# msgspec ships only as a compiled extension, there is no pure Python build to fall back to.
+# This just records which build is in use, for the startup log.
+MSGPACK_BACKEND = 'msgspec %s (%s)' % (msgspec.__version__, msgspec._core.__file__)
+
+
+def encode_message(message: dict) -> bytes:
+    """Encodes a message and prepends its length prefix."""
+    payload = enc.encode(message)
+    return len(payload).to_bytes(HEADER_SIZE, 'big') + payload
+
+
+def send_message(sock: socket.socket, message: dict):
+    """Encodes a message and sends it with its length prefix."""
+    sock.sendall(encode_message(message))
+
+
+# Constant replies, encoded once
+PONG_REPLY = encode_message({'status': 'pong'})
+BUSY_REPLY = encode_message({'error': 'Server busy'})
+
+
+# --- Command Parser Class ---
+class CommandParser:
+    """
+    Decodes command messages and executes them on the Trilobot.
+
+    Hardware calls run on a dedicated thread, so slow ones don't hold up parsing.
+    Motion commands share a single slot: if a newer one arrives before an older one
+    has run, only the newest is executed.
+    """
+    def __init__(self, tbot):
+        """
+        Initializes the CommandParser.
+
+        Args:
+            tbot: An instance of the Trilobot hardware class.
+        """
+        self.tbot = tbot
+
+        self._hw_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='HW')
+        self._motion_lock = threading.Lock()
+        self._pending_motion = None # (method, args) of the latest motion not yet executed
+
+        # Maps each command type to the bound method that executes it
+        self.handlers = {
+            ForwardCmd: self._h_forward,
+            BackwardCmd: self._h_backward,
+            TurnLeftCmd: self._h_turn_left,
+            TurnRightCmd: self._h_turn_right,
+            SetSpeedsCmd: self._h_set_speeds,
+            StopCmd: self._h_stop,
+            CoastCmd: self._h_coast,
+            SetLedCmd: self._h_set_led,
+            FillUnderlightingCmd: self._h_fill_underlighting,
+            SetUnderlightingRgbCmd: self._h_set_underlighting_rgb,
+            ReadDistanceCmd: self._h_read_distance,
+            PingCmd: self._h_ping,
+            ExitCmd: self._h_exit,
+        }
+
+    # --- Hardware Execution ---
+    @staticmethod
+    def _log_hw_error(future):
+        """Logs errors from hardware calls nobody waits on."""
+        e = future.exception()
+        if e is not None:
+            log.error("Error executing hardware command: %s", e)
+
+    def _submit(self, method, *args):
+        """Queues a hardware call on the hardware thread."""
+        self._hw_executor.submit(method, *args).add_done_callback(self._log_hw_error)
+
+    def _submit_motion(self, method, *args):
+        """Makes a motion call the pending one, queueing it unless an older one is still waiting."""
+        with self._motion_lock:
+            already_queued = self._pending_motion is not None
+            self._pending_motion = (method, args)
+        if not already_queued:
+            self._submit(self._run_pending_motion)
+
+    def _run_pending_motion(self):
+        """Runs the latest pending motion call. Executes on the hardware thread."""
+        with self._motion_lock:
+            method, args = self._pending_motion
+            self._pending_motion = None
+        method(*args)
+
+    def close(self):
+        """Stops the hardware thread once any queued calls have run."""
+        self._hw_executor.shutdown(wait=True)
+
+    # --- Motion Commands ---
+    def _h_forward(self, command: ForwardCmd, conn: socket.socket) -> bool:
+        speed = command.speed
+        self._submit_motion(self.tbot.forward, speed)
+        return True
+
+    def _h_backward(self, command: BackwardCmd, conn: socket.socket) -> bool:
+        speed = command.speed
+        self._submit_motion(self.tbot.backward, speed)
+        return True
+
+    def _h_turn_left(self, command: TurnLeftCmd, conn: socket.socket) -> bool:
+        speed = command.speed
+        self._submit_motion(self.tbot.turn_left, speed)
+        return True
+
+    def _h_turn_right(self, command: TurnRightCmd, conn: socket.socket) -> bool:
+        speed = command.speed
+        self._submit_motion(self.tbot.turn_right, speed)
+        return True
+
+    def _h_set_speeds(self, command: SetSpeedsCmd, conn: socket.socket) -> bool:
+        left = command.left
+        right = command.right
+        self._submit_motion(self.tbot.set_motor_speeds, left, right)
+        return True
+
+    def _h_stop(self, command: StopCmd, conn: socket.socket) -> bool:
+        self._submit_motion(self.tbot.stop)
+        return True
+
+    def _h_coast(self, command: CoastCmd, conn: socket.socket) -> bool:
+        self._submit_motion(self.tbot.coast)
+        return True
+
+    # --- LED Commands (Example) ---
+    def _h_set_led(self, command: SetLedCmd, conn: socket.socket) -> bool:
+        led_id = command.led
+        value = command.value
+        self._submit(self.tbot.set_button_led, led_id, value)
+        return True
+
+    def _h_fill_underlighting(self, command: FillUnderlightingCmd, conn: socket.socket) -> bool:
+        r = command.r
+        g = command.g
+        b = command.b
+        self._submit(self.tbot.fill_underlighting, r, g, b)
+        return True
+
+    def _h_set_underlighting_rgb(self, command: SetUnderlightingRgbCmd, conn: socket.socket) -> bool:
+        self._submit(self.tbot.set_underlighting_batch, command.data)
+        return True
+
+    # --- Sensor Commands (Example) ---
+    def _h_read_distance(self, command: ReadDistanceCmd, conn: socket.socket) -> bool:
+        try:
+            distance = self._hw_executor.submit(self.tbot.read_distance).result(timeout=HW_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            log.warning("Distance reading took longer than %ss.", HW_TIMEOUT)
+            return True
+        send_message(conn, {'status': 'distance', 'value': distance})
+        return True
+
+    # --- Control Commands ---
+    def _h_ping(self, command: PingCmd, conn: socket.socket) -> bool:
+        conn.sendall(PONG_REPLY)
+        return True
+
+    def _h_exit(self, command: ExitCmd, conn: socket.socket) -> bool:
+        log.info("Client requested exit.")
+        return False # Signal to disconnect
+
+    def dispatch(self, command: Command, conn: socket.socket) -> bool:
+        """Executes a decoded command. Returns False if client should disconnect."""
+        try:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Received command: %s", command)
+            return self.handlers[type(command)](command, conn)
+
+        except (ValueError, TypeError, KeyError) as e:
+            log.error("Error processing command %s: %s", command, e)
+            return True # Continue, bad command format
+        except Exception as e:
+            log.critical("Unexpected error handling command %s: %s", command, e)
+            return False # Something bad happened, disconnect
+
+    def parse(self, payload: bytes, conn: socket.socket) -> bool:
+        """Decodes a message payload and executes it. Returns False if client should disconnect."""
+        try:
+            command = dec.decode(payload)
+        except msgspec.ValidationError as e:
+            log.warning("Invalid command received: %s", e)
+            return True # Unknown action or bad arguments, continue listening
+        except msgspec.DecodeError:
+            log.error("Failed to decode message: %r", payload)
+            return True # Framing is intact, maybe the next message is valid
+
+        return self.dispatch(command, conn)
@@ -2,13 +2,13 @@
 
 import socket
 import threading
-import json
 import logging
 import time
 
 # Assuming these modules exist in the same directory or are importable
 from trilobot import Trilobot  # Your hardware class
 from video_udp_streamer import VideoStreamer
+from command_parser import CommandParser, HEADER_SIZE, MAX_MESSAGE_SIZE, BUSY_REPLY, MSGPACK_BACKEND
 
 # --- Configuration ---
 LOG_LEVEL = logging.INFO
@@ -19,13 +19,26 @@ BUFFER_SIZE = 1024    # TCP receive buffer size
 
 # --- Logging Setup ---
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+log = logging.getLogger(__name__)
+
+def _recv_exact(sock: socket.socket, n: int):
+    """Reads exactly n bytes from the socket. Returns None if the peer closed the connection."""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        received = sock.recv_into(view[got:])
+        if not received:
+            return None
+        got += received
+    return bytes(buf)
 
 # --- Command Server Class ---
 class CommandServer:
     """
     Listens for TCP connections, handles commands, and manages video streaming.
     """
-    def __init__(self, tbot: Trilobot, video_streamer: VideoStreamer, host='0.0.0.0', tcp_port=9000, udp_port=9001):
+    def __init__(self, tbot: Trilobot, video_streamer: VideoStreamer, host='0.0.0.0', tcp_port=9000, udp_port=9001, workers=1, video_group=None):
         """
         Initializes the CommandServer.
 
@@ -35,205 +48,196 @@ class CommandServer:
             host (str): The host IP address to listen on.
             tcp_port (int): The TCP port for commands.
             udp_port (int): The UDP port where video should be sent.
+            workers (int): The number of accept threads sharing the TCP port via SO_REUSEPORT.
+                With more than one, clients are served concurrently and the first one drives the video.
+            video_group (str): Multicast group to stream video to, or None to stream to the client that drives the video.
+                With a group, any number of clients may connect and all receive the same stream, which runs
+                while at least one of them is connected.
         """
         self.tbot = tbot
         self.video_streamer = video_streamer
         self.host = host
         self.tcp_port = tcp_port  # <-- Make sure this is here
         self.udp_port = udp_port  # <-- Make sure this is here
+        self.workers = max(1, int(workers))
+        self.video_group = video_group
 
-        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # One listening socket per accept worker, the kernel load-balances new connections between them
+        self.tcp_sockets = [self._create_socket() for _ in range(self.workers)]
 
         self.running = False  # <-- Make sure this is here
-        self._listen_thread = None
-        self._client_handler_thread = None
+        self._listen_threads = []
+        self._client_handler_threads = []
         self._client_lock = threading.Lock()
-        logging.info("CommandServer initialized.") # Added for clarity
+        self._video_lock = threading.Lock() # Held while the video is started or stopped, so the two never overlap
+        self._video_clients = 0 # Connected clients the video is streaming for
 
-    def _parse_command(self, command_data: str, conn: socket.socket) -> bool:
-        """Parses a JSON command and executes it. Returns False if client should disconnect."""
-        try:
-            command = json.loads(command_data)
-            action = command.get('action', '').lower()
-            logging.debug(f"Received command: {command}")
-
-            if not action:
-                logging.warning("Received command without 'action'.")
-                return True # Continue listening
-
-            # --- Motion Commands ---
-            if action == 'forward':
-                speed = float(command.get('speed', 1.0))
-                logging.info(f"Got forward command")
-                self.tbot.forward(speed)
-            elif action == 'backward':
-                speed = float(command.get('speed', 1.0))
-                self.tbot.backward(speed)
-            elif action == 'turn_left':
-                speed = float(command.get('speed', 1.0))
-                self.tbot.turn_left(speed)
-            elif action == 'turn_right':
-                speed = float(command.get('speed', 1.0))
-                self.tbot.turn_right(speed)
-            elif action == 'set_speeds':
-                left = float(command.get('left', 0.0))
-                right = float(command.get('right', 0.0))
-                self.tbot.set_motor_speeds(left, right)
-            elif action == 'stop':
-                self.tbot.stop()
-            elif action == 'coast':
-                self.tbot.coast()
-
-            # --- LED Commands (Example) ---
-            elif action == 'set_led':
-                led_id = int(command.get('led'))
-                value = float(command.get('value'))
-                self.tbot.set_button_led(led_id, value)
-            elif action == 'fill_underlighting':
-                r = int(command.get('r', 0))
-                g = int(command.get('g', 0))
-                b = int(command.get('b', 0))
-                self.tbot.fill_underlighting(r, g, b)
-
-            # --- Sensor Commands (Example) ---
-            elif action == 'read_distance':
-                distance = self.tbot.read_distance()
-                response = json.dumps({'status': 'distance', 'value': distance}) + '\n'
-                conn.sendall(response.encode('utf-8'))
-
-            # --- Control Commands ---
-            elif action == 'ping':
-                conn.sendall(b'{"status": "pong"}\n')
-            elif action == 'exit':
-                logging.info("Client requested exit.")
-                return False # Signal to disconnect
-
-            else:
-                logging.warning(f"Unknown action received: {action}")
-
-            return True # Continue listening
-
-        except json.JSONDecodeError:
-            logging.error(f"Failed to decode JSON: {command_data}")
-            return True # Continue, maybe client will send valid JSON
-        except (ValueError, TypeError, KeyError) as e:
-            logging.error(f"Error processing command {command_data}: {e}")
-            return True # Continue, bad command format
-        except Exception as e:
-            logging.critical(f"Unexpected error handling command {command_data}: {e}")
-            return False # Something bad happened, disconnect
+        self._parser = CommandParser(tbot)
+        log.info("CommandServer initialized.") # Added for clarity
+        log.info("Message encoding: %s", MSGPACK_BACKEND)
+
+    @staticmethod
+    def _create_socket() -> socket.socket:
+        """Creates a TCP socket that can share its port with the other accept workers."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return sock
 
     def _handle_client(self, conn: socket.socket, addr):
         """Handles a single client connection."""
         client_ip, client_port = addr
-        logging.info(f"Client connected: {client_ip}:{client_port}")
+        log.info("Client connected: %s:%s", client_ip, client_port)
 
-        # Start video stream to this client
-        self.video_streamer.start(client_ip, self.udp_port)
+        # Send small replies immediately and notice clients that vanish without closing
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        has_video = self._join_video(client_ip)
 
         try:
-            # Use makefile for easier line-based reading
-            client_file = conn.makefile('r', encoding='utf-8', buffering=1) # Line buffered
+            while True:
+                header = _recv_exact(conn, HEADER_SIZE)
+                if header is None:
+                    break # Client closed the connection
+
+                size = int.from_bytes(header, 'big')
+                if size > MAX_MESSAGE_SIZE:
+                    # Not a message length, e.g. a client speaking another protocol. Don't try to buffer it
+                    log.warning("Client %s:%s sent a %s byte message length, closing connection.", client_ip, client_port, size)
+                    break
 
-            for line in client_file:
-                line = line.strip()
-                if not line:
-                    continue # Skip empty lines
+                payload = _recv_exact(conn, size)
+                if payload is None:
+                    break
 
-                if not self._parse_command(line, conn):
+                if not self._parser.parse(payload, conn):
                     break # Command indicated disconnection or error
 
         except ConnectionResetError:
-            logging.warning(f"Client {client_ip}:{client_port} reset the connection.")
+            log.warning("Client %s:%s reset the connection.", client_ip, client_port)
         except Exception as e:
-            logging.error(f"Error handling client {client_ip}:{client_port}: {e}")
+            log.error("Error handling client %s:%s: %s", client_ip, client_port, e)
         finally:
-            logging.info(f"Client disconnected: {client_ip}:{client_port}")
-            self.video_streamer.stop() # Stop video stream
+            log.info("Client disconnected: %s:%s", client_ip, client_port)
+            if has_video:
+                self._leave_video()
             conn.close()
-            self._client_handler_thread = None # Mark as finished
+            with self._client_lock:
+                self._client_handler_threads.remove(threading.current_thread()) # Mark as finished
 
-    def _listen_worker(self):
+    def _join_video(self, client_ip) -> bool:
+        """
+        Starts the video for a new client if no one is watching yet. Returns whether the client counts
+        as a viewer: unicast video goes to one client only, multicast to every client that joins the group.
+        """
+        with self._video_lock:
+            if self._video_clients and not self.video_group:
+                return False
+            self._video_clients += 1
+            if self._video_clients == 1:
+                self.video_streamer.start(self.video_group or client_ip, self.udp_port)
+            return True
+
+    def _leave_video(self):
+        """Stops the video once the last client watching it has disconnected."""
+        with self._video_lock:
+            self._video_clients -= 1
+            if self._video_clients == 0:
+                self.video_streamer.stop()
+
+    def _listen_worker(self, tcp_socket: socket.socket):
         """Listens for incoming TCP connections."""
-        self.tcp_socket.bind((self.host, self.tcp_port))
-        self.tcp_socket.listen(1) # Listen for one connection
-        logging.info(f"TCP Server listening on {self.host}:{self.tcp_port}")
+        tcp_socket.bind((self.host, self.tcp_port))
+        tcp_socket.listen(1) # Listen for one connection
+        tcp_socket.settimeout(0.5) # Recheck self.running at least this often
+        log.info("TCP Server listening on %s:%s", self.host, self.tcp_port)
 
         while self.running:
             try:
-                logging.debug("Waiting for a client connection...")
-                conn, addr = self.tcp_socket.accept()
+                log.debug("Waiting for a client connection...")
+                try:
+                    conn, addr = tcp_socket.accept()
+                except socket.timeout:
+                    continue
 
                 if not self.running: # Check if stop was called while waiting
                     conn.close()
                     break
 
-                # Ensure only one client is handled at a time
                 with self._client_lock:
-                    if self._client_handler_thread and self._client_handler_thread.is_alive():
-                        logging.warning(f"Another client {addr} tried to connect. Rejecting.")
-                        conn.sendall(b'{"error": "Server busy"}\n')
+                    # With a single worker, ensure only one client is handled at a time,
+                    # unless the video is multicast and every client is a viewer
+                    if self.workers == 1 and not self.video_group and self._client_handler_threads:
+                        log.warning("Another client %s tried to connect. Rejecting.", addr)
+                        conn.sendall(BUSY_REPLY)
                         conn.close()
                     else:
                         # Start a thread to handle this client
-                        self._client_handler_thread = threading.Thread(
+                        handler_thread = threading.Thread(
                             target=self._handle_client,
                             args=(conn, addr),
                             name="TCPClientHandler",
                             daemon=True
                         )
-                        self._client_handler_thread.start()
+                        self._client_handler_threads.append(handler_thread)
+                        handler_thread.start()
 
             except OSError as e:
                 if self.running: # Only log if we weren't expecting a close
-                    logging.error(f"Socket error: {e}")
+                    log.error("Socket error: %s", e)
                 else:
-                    logging.info("Socket closed for shutdown.")
+                    log.info("Socket closed for shutdown.")
                 break # Exit loop on error or shutdown
             except Exception as e:
-                logging.critical(f"Unexpected error in listen worker: {e}")
+                log.critical("Unexpected error in listen worker: %s", e)
                 time.sleep(1) # Prevent rapid-fire errors
 
-        logging.info("Listen worker stopped.")
+        tcp_socket.close() # Stop the kernel routing new connections to this worker
+        log.info("Listen worker stopped.")
 
     def start(self):
-        """Starts the TCP server listening thread."""
+        """Starts the TCP server listening threads."""
         if self.running:
-            logging.warning("Server is already running.")
+            log.warning("Server is already running.")
             return
 
         self.running = True
-        self._listen_thread = threading.Thread(target=self._listen_worker, name="TCPListenThread", daemon=True)
-        self._listen_thread.start()
+        for i, tcp_socket in enumerate(self.tcp_sockets):
+            name = "TCPListenThread" if self.workers == 1 else f"TCPListenThread-{i}"
+            listen_thread = threading.Thread(target=self._listen_worker, args=(tcp_socket,), name=name, daemon=True)
+            self._listen_threads.append(listen_thread)
+            listen_thread.start()
 
     def stop(self):
         """Stops the TCP server."""
         if not self.running:
-            logging.warning("Server is not running.")
+            log.warning("Server is not running.")
             return
 
-        logging.info("Stopping TCP Server...")
+        log.info("Stopping TCP Server...")
         self.running = False
         self.video_streamer.stop() # Ensure video stops
 
-        # To unblock socket.accept(), we can try connecting to ourselves.
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(0.5)
-                s.connect((self.host if self.host != '0.0.0.0' else '127.0.0.1', self.tcp_port))
-        except Exception:
-             pass # This is expected if already closing or no connection
+        # Shutting down the listening sockets wakes any blocked socket.accept() immediately
+        for tcp_socket in self.tcp_sockets:
+            try:
+                tcp_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # Not listening yet, or already closed
+            tcp_socket.close()
 
-        self.tcp_socket.close() # Close the main socket
+        for listen_thread in self._listen_threads:
+            listen_thread.join(timeout=2)
 
-        if self._listen_thread:
-            self._listen_thread.join(timeout=2)
+        with self._client_lock:
+            client_handler_threads = list(self._client_handler_threads)
+        for client_handler_thread in client_handler_threads: # If clients were connected
+            client_handler_thread.join(timeout=2)
 
-        if self._client_handler_thread: # If a client was connected
-            self._client_handler_thread.join(timeout=2)
+        self._parser.close() # Finish any queued hardware commands
 
-        logging.info("TCP Server stopped.")
+        log.info("TCP Server stopped.")
 
     def __del__(self):
         self.stop()
@@ -243,10 +247,12 @@ class CommandServer:
 class MockTrilobot:
     """A dummy Trilobot class for testing the server without hardware."""
     def __getattr__(self, name):
+        # Only called the first time a name is looked up, after which the instance attribute is found
         def method(*args, **kwargs):
             print(f"MOCK_TBOT: Called {name} with args={args}, kwargs={kwargs}")
             if name == 'read_distance':
                 return 99.9
+        setattr(self, name, method)
         return method
 
 class MockVideoStreamer:
@@ -270,7 +276,7 @@ if __name__ == "__main__":
     try:
         server.start()
         print(f"Mock server started. Connect via TCP on port {TCP_PORT}.")
-        print("Send JSON commands, e.g.,:")
+        print("Send length-prefixed msgpack commands, e.g.,:")
         print('  {"action": "forward", "speed": 0.5}')
         print('  {"action": "stop"}')
         print('  {"action": "exit"}')
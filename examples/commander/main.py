@@ -17,6 +17,7 @@ if os.path.isdir(SYSTEM_PACKAGES_PATH) and SYSTEM_PACKAGES_PATH not in sys.path:
 LOG_LEVEL = logging.INFO
 TCP_SERVER_PORT = 9000
 UDP_VIDEO_PORT = 9001
+VIDEO_MULTICAST_GROUP = None # e.g. '239.0.0.1' to accept any number of clients and stream to all that join the group, instead of one client
 
 # --- Logging Setup ---
 # Setup logging for this main script
@@ -57,7 +58,8 @@ def main():
 
         # --- 3. Initialize & Start Command Server ---
         logging.info("Initializing Command Server...")
-        server = CommandServer(tbot, streamer, tcp_port=TCP_SERVER_PORT, udp_port=UDP_VIDEO_PORT)
+        server = CommandServer(tbot, streamer, tcp_port=TCP_SERVER_PORT, udp_port=UDP_VIDEO_PORT,
+                               video_group=VIDEO_MULTICAST_GROUP)
         server.start()
         logging.info(f"Command Server started. Listening on TCP port {TCP_SERVER_PORT}.")
         logging.info(f"Video will stream via UDP on port {UDP_VIDEO_PORT} once a client connects.")
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Optionally compiles the commander's speedups with Cython:
+
+- command_parser.py, the command parser, compiled as is.
+- _stream_sender.pyx, a video fragment sender that runs without the GIL (Linux only).
+
+The commander runs fine as plain Python. To build the compiled modules in place, run:
+
+    TRILOBOT_COMMANDER_SPEEDUPS=1 python3 setup.py build_ext --inplace
+
+Without TRILOBOT_COMMANDER_SPEEDUPS set, nothing is compiled and the pure Python
+command_parser.py and video sender are used.
+"""
+
+import os
+import sys
+
+from setuptools import Extension, setup
+
+ext_modules = []
+if os.environ.get('TRILOBOT_COMMANDER_SPEEDUPS'):
+    from Cython.Build import cythonize
+    # Named explicitly so the module builds next to the scripts that import it
+    extensions = [Extension('command_parser', ['command_parser.py'])]
+    if sys.platform.startswith('linux'):
+        # _GNU_SOURCE makes glibc declare sendmmsg()
+        extensions.append(Extension('_stream_sender', ['_stream_sender.pyx'], define_macros=[('_GNU_SOURCE', None)]))
+    ext_modules = cythonize(extensions, language_level=3)
+
+setup(
+    name='trilobot-commander',
+    py_modules=['command_parser'],
+    ext_modules=ext_modules,
+)
@@ -1,31 +1,43 @@
 #!/usr/bin/env python3
 
 import socket
+import selectors
+import struct
 import threading
-import json
 import logging
 import time
+import msgspec
 import numpy as np
 import cv2 # OpenCV for video display
 
+from command_parser import HEADER_SIZE, MAX_MESSAGE_SIZE, MSGPACK_BACKEND, encode_message
+
 # --- Configuration ---
 LOG_LEVEL = logging.INFO
-UDP_BUFFER_SIZE = 65536 # Large enough for most JPEGs
+UDP_BUFFER_SIZE = 65536 # Large enough for any video datagram
 TCP_TIMEOUT = 5.0       # Seconds for TCP connection attempt
-UDP_TIMEOUT = 1.0       # Seconds for UDP receive timeout
+UDP_DRAIN_MAX = 256     # Most video datagrams received per wakeup (a few frames), so TCP replies aren't held up
+MIN_SEND_INTERVAL = 0.05 # Minimum seconds between teleop commands
+FRAGMENT_HEADER = struct.Struct('!IHH') # Frame id, fragment index, fragment count in front of every video datagram
+
+# --- Wire Protocol ---
+# Framing and encoding are shared with the robot (see command_parser.py). Replies are plain maps
+dec = msgspec.msgpack.Decoder(dict)
 
 # --- Logging Setup ---
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
 
 # --- Robot Client Class ---
 class RobotClient:
     """
     Connects to the robot, sends commands, and receives video.
     """
-    def __init__(self, robot_ip: str, tcp_port: int = 9000, udp_port: int = 9001):
+    def __init__(self, robot_ip: str, tcp_port: int = 9000, udp_port: int = 9001, multicast_group: str = None):
         self.robot_ip = robot_ip
         self.tcp_port = tcp_port
         self.udp_port = udp_port
+        self.multicast_group = multicast_group # Group the robot streams video to, if it multicasts
 
         self.tcp_socket = None
         self.udp_socket = None
@@ -33,56 +45,78 @@ class RobotClient:
         self.is_connected = False
         self._running = False
 
+        # Latest decoded frame, replaced (never modified) by the UDP thread. Storing and reading a
+        # single attribute is atomic, so the display thread sees either the old or new frame, no lock needed.
         self._video_frame = None
-        self._video_lock = threading.Lock()
 
-        self._udp_thread = None
-        self._tcp_recv_thread = None # To handle potential responses
+        # Every datagram is received into this one buffer, then its payload is appended to the frame being reassembled
+        self._udp_buffer = bytearray(UDP_BUFFER_SIZE)
+        self._udp_view = memoryview(self._udp_buffer)
+        self._frame_buffer = bytearray()
+        self._frame_id = None
+        self._next_fragment = None # Index of the fragment expected next, None while waiting for a frame to start
+        self.skipped_frames = 0 # Frames superseded by a newer one before they were decoded
+
+        # Commands are queued here and written to the socket together by flush()
+        self._outbuf = bytearray()
+        self._send_lock = threading.Lock()
+
+        self._tcp_inbuf = bytearray() # Received TCP bytes not yet handled as a complete message
+
+        self._io_thread = None # Receives both video and responses
 
     def connect(self) -> bool:
         """Establishes TCP and UDP connections."""
         if self.is_connected:
-            logging.warning("Already connected.")
+            log.warning("Already connected.")
             return True
 
-        logging.info(f"Attempting to connect to {self.robot_ip}...")
+        log.info("Attempting to connect to %s...", self.robot_ip)
         try:
             # --- TCP Connection ---
-            logging.debug(f"Connecting TCP to {self.robot_ip}:{self.tcp_port}...")
+            log.debug("Connecting TCP to %s:%s...", self.robot_ip, self.tcp_port)
             self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.tcp_socket.settimeout(TCP_TIMEOUT)
             self.tcp_socket.connect((self.robot_ip, self.tcp_port))
             self.tcp_socket.settimeout(None) # Remove timeout after connection
-            logging.info("TCP Connected.")
+            self.tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Don't let Nagle hold back commands
+            log.info("TCP Connected.")
 
             # --- UDP Setup ---
-            logging.debug(f"Setting up UDP listener on port {self.udp_port}...")
+            log.debug("Setting up UDP listener on port %s...", self.udp_port)
             self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self.multicast_group:
+                # Let other viewers on this machine bind the same port, the kernel gives each a copy
+                self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.udp_socket.bind(('', self.udp_port)) # Listen on all interfaces
-            self.udp_socket.settimeout(UDP_TIMEOUT)
-            logging.info(f"UDP Listening on port {self.udp_port}.")
+            if self.multicast_group:
+                membership = struct.pack('=4sl', socket.inet_aton(self.multicast_group), socket.INADDR_ANY)
+                self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                log.info("Joined multicast group %s.", self.multicast_group)
+            self.udp_socket.setblocking(False) # The I/O thread's selector does the waiting
+            log.info("UDP Listening on port %s.", self.udp_port)
 
             self.is_connected = True
             self._running = True
 
-            # --- Start Listener Threads ---
-            self._udp_thread = threading.Thread(target=self._udp_listen_worker, daemon=True, name="UDPClientThread")
-            self._udp_thread.start()
-            self._tcp_recv_thread = threading.Thread(target=self._tcp_listen_worker, daemon=True, name="TCPClientRecvThread")
-            self._tcp_recv_thread.start()
+            # --- Start Listener Thread ---
+            self._tcp_inbuf.clear()
+            self._next_fragment = None
+            self._io_thread = threading.Thread(target=self._io_worker, daemon=True, name="ClientIOThread")
+            self._io_thread.start()
 
             return True
 
         except socket.timeout:
-            logging.error(f"Connection timed out ({TCP_TIMEOUT}s). Is robot running and IP {self.robot_ip} correct?")
+            log.error("Connection timed out (%ss). Is robot running and IP %s correct?", TCP_TIMEOUT, self.robot_ip)
             self._cleanup_sockets()
             return False
         except ConnectionRefusedError:
-            logging.error(f"Connection refused. Is the robot's CommandServer running on port {self.tcp_port}?")
+            log.error("Connection refused. Is the robot's CommandServer running on port %s?", self.tcp_port)
             self._cleanup_sockets()
             return False
         except Exception as e:
-            logging.error(f"Failed to connect: {e}", exc_info=True)
+            log.error("Failed to connect: %s", e, exc_info=True)
             self._cleanup_sockets()
             return False
 
@@ -96,84 +130,160 @@ class RobotClient:
             self.udp_socket = None
         self.is_connected = False
 
-    def _udp_listen_worker(self):
-        """Listens for incoming UDP video frames."""
-        logging.info("UDP listener thread started.")
-        while self._running:
+    def _add_fragment(self, nbytes: int):
+        """
+        Adds the fragment in the receive buffer to the frame being reassembled, returning the frame
+        once its last fragment is in. Fragments must arrive in order, a frame missing any is dropped.
+        """
+        frame_id, index, count = FRAGMENT_HEADER.unpack_from(self._udp_buffer)
+        if index == 0:
+            self._frame_id = frame_id
+            self._frame_buffer.clear()
+        elif frame_id != self._frame_id or index != self._next_fragment:
+            self._next_fragment = None # Lost or out of order, wait for the next frame to start
+            return None
+
+        self._frame_buffer += self._udp_view[FRAGMENT_HEADER.size:nbytes]
+        self._next_fragment = index + 1
+        if self._next_fragment < count:
+            return None
+
+        frame = self._frame_buffer
+        self._frame_buffer = bytearray()
+        self._next_fragment = None
+        return frame
+
+    def _on_udp(self, sock: socket.socket):
+        """
+        Receives the video fragments already queued, up to UDP_DRAIN_MAX, then decodes the newest frame
+        they completed, so no time is spent decoding frames that would never be displayed.
+        """
+        jpeg = None
+        for _ in range(UDP_DRAIN_MAX): # Any left over are received on the next wakeup, after TCP has had its turn
             try:
-                data, addr = self.udp_socket.recvfrom(UDP_BUFFER_SIZE)
-                if addr[0] == self.robot_ip: # Only accept video from our robot
-                    with self._video_lock:
-                        self._video_frame = data
-            except socket.timeout:
-                continue # Just check self._running again
-            except Exception as e:
-                if self._running: # Only log if we weren't expecting a close
-                    logging.error(f"UDP receive error: {e}")
+                nbytes, addr = sock.recvfrom_into(self._udp_buffer, UDP_BUFFER_SIZE)
+            except BlockingIOError:
+                break # Queue drained
+            if addr[0] == self.robot_ip and nbytes >= FRAGMENT_HEADER.size: # Only accept video from our robot
+                frame = self._add_fragment(nbytes)
+                if frame is not None:
+                    if jpeg is not None:
+                        self.skipped_frames += 1
+                    jpeg = frame
+        if jpeg is None:
+            return
+
+        # Decode here rather than on the display thread, so the two overlap
+        try:
+            frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error as e:
+            log.warning("Failed to decode JPEG frame: %s", e)
+            return
+        if frame is not None:
+            self._video_frame = frame
+
+    def _on_tcp(self, sock: socket.socket):
+        """Reads whatever has arrived on the TCP socket and handles each complete message (acks, sensor data)."""
+        data = sock.recv(4096)
+        if not data:
+            if self._running: # Not a close we asked for
+                log.warning("TCP connection closed by server.")
+                self.disconnect() # Initiate disconnect if server closes
+            return
+
+        # A message may arrive in pieces, so keep any partial one until the rest turns up
+        buf = self._tcp_inbuf
+        buf += data
+        while len(buf) >= HEADER_SIZE:
+            size = int.from_bytes(buf[:HEADER_SIZE], 'big')
+            if size > MAX_MESSAGE_SIZE:
+                log.error("Robot sent a %s byte message length, disconnecting.", size)
+                self.disconnect()
+                return
+            end = HEADER_SIZE + size
+            if len(buf) < end:
                 break
-        logging.info("UDP listener thread stopped.")
+            payload = bytes(buf[HEADER_SIZE:end])
+            del buf[:end]
 
-    def _tcp_listen_worker(self):
-        """Listens for any incoming TCP messages (acks, sensor data)."""
-        logging.info("TCP listener thread started.")
-        buffer = ""
+            try:
+                message = dec.decode(payload)
+            except msgspec.DecodeError:
+                log.warning("Failed to decode message: %r", payload)
+                continue
+            log.info("Robot says: %s", message)
+
+    def _io_worker(self):
+        """Services both the UDP video socket and the TCP socket from a single thread."""
+        log.info("I/O thread started.")
+        selector = selectors.DefaultSelector()
+        selector.register(self.udp_socket, selectors.EVENT_READ, self._on_udp)
+        selector.register(self.tcp_socket, selectors.EVENT_READ, self._on_tcp)
         try:
             while self._running:
-                data = self.tcp_socket.recv(1024)
-                if not data:
-                    logging.warning("TCP connection closed by server.")
-                    self.disconnect() # Initiate disconnect if server closes
-                    break
-
-                buffer += data.decode('utf-8', errors='ignore')
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line:
-                        logging.info(f"Robot says: {line}")
-                        # You can add JSON parsing here if you expect structured responses
+                for key, _ in selector.select(timeout=0.5): # Timeout so self._running is checked
+                    key.data(key.fileobj)
+                    if not self._running:
+                        break
         except ConnectionAbortedError:
-             logging.warning("TCP connection aborted.")
+            log.warning("TCP connection aborted.")
         except Exception as e:
-            if self._running:
-                logging.error(f"TCP receive error: {e}")
+            if self._running: # Only log if we weren't expecting a close
+                log.error("Receive error: %s", e)
         finally:
-            logging.info("TCP listener thread stopped.")
+            selector.close()
+            log.info("I/O thread stopped.")
             if self._running: # If we stopped due to error, initiate full disconnect
-                 self.disconnect()
-
+                self.disconnect()
 
     def get_latest_frame(self):
-        """Gets the latest video frame and decodes it using OpenCV."""
-        frame_data = None
-        with self._video_lock:
-            frame_data = self._video_frame
-
-        if frame_data:
-            try:
-                np_arr = np.frombuffer(frame_data, np.uint8)
-                frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                return frame
-            except Exception as e:
-                logging.warning(f"Failed to decode JPEG frame: {e}")
-                return None
-        return None
+        """Gets the latest decoded video frame, or None if no frame has arrived yet."""
+        return self._video_frame
 
     def send_command(self, action: str, **kwargs):
-        """Sends a command as JSON over TCP."""
+        """Queues a command as a length-prefixed msgpack message. Call flush() to send it."""
+        command = {'action': action, **kwargs}
+        self.send_encoded(encode_message(command))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Queued: %s", command)
+
+    def send_underlighting(self, colors):
+        """
+        Queues new colors for all underlights as one command. Call flush() to send it.
+
+        Args:
+            colors: A (6, 3) array, or any sequence of 18 values from 0 to 255, of R, G, B per underlight.
+        """
+        self.send_command('set_underlighting_rgb', data=np.asarray(colors, dtype=np.uint8).tobytes())
+
+    def send_encoded(self, message: bytes):
+        """Queues a message already encoded with encode_message. Call flush() to send it."""
         if not self.is_connected or not self.tcp_socket:
-            logging.error("Not connected. Cannot send command.")
+            log.error("Not connected. Cannot send command.")
             return
 
-        try:
-            command = {'action': action, **kwargs}
-            json_str = json.dumps(command) + '\n' # Add newline as delimiter
-            self.tcp_socket.sendall(json_str.encode('utf-8'))
-            logging.debug(f"Sent: {json_str.strip()}")
-        except BrokenPipeError:
-            logging.error("Connection broken. Attempting to disconnect.")
+        with self._send_lock:
+            self._outbuf += message
+
+    def flush(self):
+        """Sends all queued commands over TCP in a single write."""
+        error = None
+        with self._send_lock:
+            if not self._outbuf:
+                return
+            try:
+                if self.tcp_socket:
+                    self.tcp_socket.sendall(self._outbuf) # Sent straight from the bytearray, no copy
+            except Exception as e:
+                error = e
+            finally:
+                self._outbuf.clear()
+
+        if isinstance(error, BrokenPipeError):
+            log.error("Connection broken. Attempting to disconnect.")
             self.disconnect()
-        except Exception as e:
-            logging.error(f"Failed to send command: {e}")
+        elif error is not None:
+            log.error("Failed to send command: %s", error)
             self.disconnect() # Disconnect on error
 
     def disconnect(self):
@@ -181,13 +291,14 @@ class RobotClient:
         if not self._running:
             return
 
-        logging.info("Disconnecting...")
+        log.info("Disconnecting...")
         self._running = False
 
         if self.tcp_socket:
             try:
                 # Politely tell the server we're leaving (optional)
                 self.send_command('exit')
+                self.flush()
                 time.sleep(0.1) # Give it a moment
                 self.tcp_socket.shutdown(socket.SHUT_RDWR)
             except Exception:
@@ -200,12 +311,24 @@ class RobotClient:
             self.udp_socket.close()
             self.udp_socket = None
 
-        # Wait for threads to finish (optional, as they are daemons)
-        # if self._udp_thread: self._udp_thread.join(timeout=1)
-        # if self._tcp_recv_thread: self._tcp_recv_thread.join(timeout=1)
+        # Wait for the I/O thread to finish (optional, as it is a daemon)
+        # if self._io_thread: self._io_thread.join(timeout=1)
 
         self.is_connected = False
-        logging.info("Disconnected.")
+        log.info("Disconnected.")
+
+# --- Teleop Key Bindings ---
+# Encoded once up front, so each keypress is just a copy into the send buffer
+TELEOP_COMMANDS = {
+    ord('w'): encode_message({'action': 'forward', 'speed': 2.0}),
+    ord('s'): encode_message({'action': 'backward', 'speed': 0.8}),
+    ord('a'): encode_message({'action': 'turn_left', 'speed': 0.7}),
+    ord('d'): encode_message({'action': 'turn_right', 'speed': 0.7}),
+    ord('x'): encode_message({'action': 'stop'}),
+    ord('p'): encode_message({'action': 'ping'}),
+    ord('l'): encode_message({'action': 'fill_underlighting', 'r': 0, 'g': 0, 'b': 200}),
+}
+STOP_COMMAND = TELEOP_COMMANDS[ord('x')]
 
 # --- Example Usage (Interactive Control) ---
 if __name__ == "__main__":
@@ -214,6 +337,7 @@ if __name__ == "__main__":
         print("IP address required.")
         exit(1)
 
+    log.info("Message encoding: %s", MSGPACK_BACKEND)
     client = RobotClient(robot_ip)
 
     if not client.connect():
@@ -232,6 +356,8 @@ if __name__ == "__main__":
 
     cv2.namedWindow("Trilobot Feed")
     last_command_sent = None # Track the last command
+    last_send_time = 0.0
+    pending_command = None # Waiting to be sent, kept until it goes out or a newer key replaces it
 
     try:
         while True:
@@ -245,44 +371,34 @@ if __name__ == "__main__":
 
             key = cv2.waitKey(50) & 0xFF # Wait 50ms for a key
 
-            command_to_send = None
-
-            if key == ord('w'):
-                command_to_send = {'action': 'forward', 'speed': 2.0}
-            elif key == ord('s'):
-                command_to_send = {'action': 'backward', 'speed': 0.8}
-            elif key == ord('a'):
-                command_to_send = {'action': 'turn_left', 'speed': 0.7}
-            elif key == ord('d'):
-                command_to_send = {'action': 'turn_right', 'speed': 0.7}
-            elif key == ord('x'):
-                command_to_send = {'action': 'stop'}
-            elif key == ord('p'):
-                command_to_send = {'action': 'ping'}
-            elif key == ord('l'):
-                 command_to_send = {'action': 'fill_underlighting', 'r': 0, 'g': 0, 'b': 200}
-            elif key == ord('q'):
+            if key == ord('q'):
                 break # Exit loop
+            elif key in TELEOP_COMMANDS:
+                pending_command = TELEOP_COMMANDS[key]
             elif key != 0xFF: # 0xFF (or -1 depending on OS/version) means no key pressed
-                command_to_send = {'action': 'stop'} # Stop if an *unassigned* key is pressed
-            else: # No key was pressed (key == 0xFF or -1)
-                command_to_send = {'action': 'stop'}
-
-            # Only send if the command is new
-            if command_to_send and command_to_send != last_command_sent:
-                client.send_command(**command_to_send)
-                last_command_sent = command_to_send
-            # If no new command, but the last one was movement, AND no key was pressed, send stop.
-            # This ensures it stops when you release a key.
-            elif not command_to_send and last_command_sent and last_command_sent.get('action') != 'stop':
-                 client.send_command(action='stop')
-                 last_command_sent = {'action': 'stop'}
-
+                pending_command = STOP_COMMAND # Stop if an *unassigned* key is pressed
+            elif pending_command is None and last_command_sent is not None and last_command_sent != STOP_COMMAND:
+                pending_command = STOP_COMMAND # Key released, so stop (just once)
+
+            # Only send if the command is new, and not faster than MIN_SEND_INTERVAL.
+            # A rate-limited command stays pending, so a quick tap still goes out on a later loop.
+            if pending_command == last_command_sent:
+                pending_command = None # Already the robot's current command
+            elif pending_command is not None:
+                now = time.monotonic()
+                if now - last_send_time >= MIN_SEND_INTERVAL:
+                    client.send_encoded(pending_command)
+                    last_command_sent = pending_command
+                    last_send_time = now
+                    pending_command = None
+
+            client.flush() # At most one write per loop
 
     finally:
         print("Shutting down client...")
         if client.is_connected:
             client.send_command('stop') # Ensure robot stops before disconnecting
+            client.flush()
             time.sleep(0.1)
             client.disconnect()
         cv2.destroyAllWindows()
@@ -1,150 +1,467 @@
 #!/usr/bin/env python3
 
-import io
+import os
+import errno
+import sys
 import time
+import ctypes
+import ctypes.util
+import ipaddress
 import logging
 import socket
+import struct
 import threading
 
 try:
     from picamera2 import Picamera2
     from picamera2.encoders import JpegEncoder
-    from picamera2.outputs import FileOutput
+    # The V4L2 hardware encoder itself. picamera2.encoders.MJPEGEncoder is swapped for a libav (CPU)
+    # encoder on boards without one, such as the Pi 5, so it would never fail over to JpegEncoder
+    from picamera2.encoders.mjpeg_encoder import MJPEGEncoder
+    from picamera2.outputs import Output
 except ImportError:
     print("Error: picamera2 library not found.")
     print("Please ensure it is installed and accessible.")
     # You might want to fall back to a dummy class or exit if essential
     Picamera2 = None # Set to None to handle absence later
+    Output = object # So UDPOutput can still be defined
+
+try:
+    import fcntl
+    import termios
+    SIOCOUTQ = termios.TIOCOUTQ # Same request for sockets: bytes not yet sent from the send buffer
+except (ImportError, AttributeError):
+    SIOCOUTQ = None
+
+try:
+    from _stream_sender import send_frame as _send_frame_compiled # Sends without holding the GIL
+except ImportError:
+    _send_frame_compiled = None # Not built, see setup.py
 
 # --- Configuration ---
 LOG_LEVEL = logging.INFO
 MAX_UDP_PACKET_SIZE = 65507  # Max theoretical UDP payload size
+SENDMMSG_MAX = 1024          # Most datagrams the kernel accepts in one sendmmsg call (UIO_MAXIOV)
+UNROLL_MAX = 64              # Frames of up to this many fragments are sent with a generated, unrolled fill function
+UDP_SEND_BUFFER = 1 << 20    # Kernel send buffer size, so bursts queue instead of dropping
+SENDER_NICE = -5             # Niceness boost for the thread sending frames, applied only if allowed (e.g. as root)
+CONGESTED_QUEUE = UDP_SEND_BUFFER // 4 # Bytes still queued in the kernel after a send that count as backpressure
+DECREASE_HOLDOFF = 0.25      # Seconds after backing off before backing off again
+INCREASE_INTERVAL = 1.0      # Seconds without backpressure before stepping back up
+MIN_QUALITY_SCALE = 0.25     # Lowest fraction of the configured quality (or frame rate) to back off to
+SEND_ERROR_LOG_EVERY = 100   # Log only one failed send in this many
+MAX_DATAGRAM = 1400          # Default datagram size (header included), below a typical path MTU so IP never fragments it
+MULTICAST_TTL = 2            # Router hops a multicast stream may cross, enough for a LAN without leaking further
+
+# Linux socket options not exposed by Python's socket module
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2) # Never fragment, fail sends larger than the path MTU
+
+# --- Video Protocol ---
+# Each frame is split into datagrams of up to max_datagram bytes, sent in order.
+# Every datagram starts with this header: frame id, fragment index, fragment count.
+FRAGMENT_HEADER = struct.Struct('!IHH')
 
 # --- Logging Setup ---
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+log = logging.getLogger(__name__)
+
+# --- Batched UDP Sends ---
+# sendmmsg() sends several datagrams with a single system call. Python's socket module
+# doesn't expose it, so it is called through ctypes where libc provides it (Linux).
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+def _load_sendmmsg():
+    """Returns libc's sendmmsg function, or None if it isn't available."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+_sendmmsg = _load_sendmmsg()
+
+class _DatagramBatch:
+    """
+    Sends frames as fragment datagrams on a connected socket, a whole frame per system call.
+    Each datagram is gathered by the kernel from two buffers, its header and its slice of the frame,
+    so nothing is copied in Python. The message headers and fragment headers are allocated when a
+    frame first needs that many. After that, headers are packed in place and only the payload
+    pointers change per send, so sending allocates nothing.
+
+    Frame sizes barely change from one frame to the next, so the same fragment counts come up
+    over and over. For each count up to UNROLL_MAX, a fill function is generated the first time
+    it is needed, with the per-fragment loop unrolled and every offset written in as a constant.
+    """
+    def __init__(self, sock):
+        self._fd = sock.fileno()
+        self._capacity = 0
+        self._reserve(UNROLL_MAX) # Enough for frames up to about 90KB
+
+    def _reserve(self, count):
+        """Makes room for sending count datagrams in one call."""
+        if count <= self._capacity:
+            return
+        self._headers = (ctypes.c_char * (FRAGMENT_HEADER.size * count))() # One fragment header per message
+        self._iovs = (_iovec * (2 * count))() # Header and payload for each message
+        self._msgs = (_mmsghdr * count)()
+        headers_address = ctypes.addressof(self._headers)
+        for i, msg in enumerate(self._msgs):
+            header_iov = self._iovs[2 * i]
+            header_iov.iov_base = headers_address + i * FRAGMENT_HEADER.size
+            header_iov.iov_len = FRAGMENT_HEADER.size
+            msg.msg_hdr.msg_iov = ctypes.pointer(header_iov) # No address, the socket is connected to the target
+            msg.msg_hdr.msg_iovlen = 2
+        self._capacity = count
+        self._fills = {} # (fragment count, payload size) -> generated fill function, bound to the arrays above
+
+    def _generate_fill(self, count, payload_size):
+        """Generates a function that writes the headers and payload pointers for a frame of count fragments."""
+        lines = ['def fill(frame_id, base, size):']
+        for i in range(count):
+            offset = i * payload_size
+            lines.append(f'    pack_into(headers, {i * FRAGMENT_HEADER.size}, frame_id, {i}, {count})')
+            lines.append(f'    iov{i}.iov_base = base + {offset}')
+            lines.append(f'    iov{i}.iov_len = {payload_size}' if i < count - 1 else f'    iov{i}.iov_len = size - {offset}')
+
+        # The payload iovecs are looked up once here, rather than indexed out of the array on every send
+        namespace = {'pack_into': FRAGMENT_HEADER.pack_into, 'headers': self._headers}
+        namespace.update((f'iov{i}', self._iovs[2 * i + 1]) for i in range(count))
+        exec('\n'.join(lines), namespace)
+        fill = self._fills[count, payload_size] = namespace['fill']
+        return fill
+
+    def _submit(self, count):
+        """Sends the first count prepared messages."""
+        sent = 0
+        while sent < count: # The kernel may accept fewer than asked for
+            n = _sendmmsg(self._fd, ctypes.addressof(self._msgs) + sent * ctypes.sizeof(_mmsghdr), count - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            sent += n
+
+    def send(self, frame, frame_id, count, payload_size):
+        """Sends a bytes frame as count datagrams, each carrying the next payload_size bytes of the frame."""
+        base = ctypes.cast(frame, ctypes.c_void_p).value
+        size = len(frame)
+        if count <= UNROLL_MAX:
+            fill = self._fills.get((count, payload_size)) or self._generate_fill(count, payload_size)
+            fill(frame_id, base, size)
+            self._submit(count)
+            return
 
-# --- Streaming Output Buffer ---
-class StreamingOutput(io.BufferedIOBase):
+        self._reserve(min(count, SENDMMSG_MAX))
+        for start in range(0, count, SENDMMSG_MAX):
+            batch = min(count - start, SENDMMSG_MAX)
+            for i in range(batch):
+                FRAGMENT_HEADER.pack_into(self._headers, i * FRAGMENT_HEADER.size, frame_id, start + i, count)
+                offset = (start + i) * payload_size
+                payload_iov = self._iovs[2 * i + 1]
+                payload_iov.iov_base = base + offset
+                payload_iov.iov_len = min(payload_size, size - offset)
+            self._submit(batch)
+
+# --- Encoder Output ---
+class UDPOutput(Output):
     """
-    A buffer class that holds the latest captured frame and uses a
-    Condition to notify waiting threads when a new frame is available.
+    A picamera2 output that sends each frame as soon as the encoder produces it,
+    on the encoder's own thread, so frames are never queued or handed between threads.
     """
-    def __init__(self):
-        self.frame = None
-        self.condition = threading.Condition()
+    def __init__(self, streamer):
+        super().__init__()
+        self.streamer = streamer
+        self._tuned = False
 
-    def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if not self._tuned: # First frame, now we know which thread sends
+            self.streamer._tune_sender_thread()
+            self._tuned = True
+        self.streamer._on_frame(frame)
 
 # --- Video Streamer Class ---
 class VideoStreamer:
     """
     Manages camera capture and streams video frames over UDP.
     """
-    def __init__(self, resolution=(640, 480), framerate=24, jpeg_quality=85):
+    def __init__(self, resolution=(640, 480), framerate=24, jpeg_quality=85, bitrate=None, hardware_encoder=True,
+                 max_datagram=MAX_DATAGRAM, low_bandwidth=False, multicast_interface=None):
+        """
+        Args:
+            resolution: (width, height) of the streamed video.
+            framerate: Frames per second to capture.
+            jpeg_quality: JPEG quality (1-100), used by the software encoder.
+            bitrate: Target bitrate in bits per second for the hardware encoder, or None to let picamera2 choose.
+            hardware_encoder: Encode on the Pi's hardware MJPEG encoder, falling back to software if it isn't available.
+            max_datagram: Largest datagram to send, header included. Keep it below the path MTU to the client.
+            low_bandwidth: Stream at half the resolution in each direction, scaled down by the camera's ISP.
+            multicast_interface: IPv4 address of the interface to send multicast video from, or None to let the routing table choose.
+        """
         if Picamera2 is None:
             raise RuntimeError("Picamera2 library is not available.")
+        if not FRAGMENT_HEADER.size < max_datagram <= MAX_UDP_PACKET_SIZE:
+            raise ValueError(f"max_datagram must be between {FRAGMENT_HEADER.size + 1} and {MAX_UDP_PACKET_SIZE}")
 
         self.picam2 = Picamera2()
-        self.resolution = resolution
+        if low_bandwidth:
+            # A quarter of the pixels to encode and send. The ISP scales for free, nothing is resized on the CPU
+            resolution = (resolution[0] // 2, resolution[1] // 2)
         self.framerate = framerate
         self.jpeg_quality = jpeg_quality
+        self.bitrate = bitrate
 
-        # Configure camera
+        # Configure camera. YUV420 is what the encoders take natively, so no colour conversion is needed on the CPU,
+        # and with chroma at quarter resolution it's half the size of RGB for the encoder to read
         config = self.picam2.create_video_configuration(
-            main={"size": self.resolution},
+            main={"size": resolution, "format": "YUV420"},
             controls={"FrameRate": float(self.framerate)} # Ensure it's float
         )
+        self.picam2.align_configuration(config) # Round the size to one the ISP can output efficiently
         self.picam2.configure(config)
+        self.resolution = config["main"]["size"]
 
-        self.output = StreamingOutput()
-        self.encoder = JpegEncoder(q=self.jpeg_quality)
+        self.encoder = self._create_encoder(hardware_encoder)
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SEND_BUFFER)
+        self.udp_socket.setblocking(False) # A full send buffer drops the frame instead of stalling the stream
+        if sys.platform.startswith('linux'):
+            # A datagram too big for the path fails with EMSGSIZE, rather than being split up by IP
+            self.udp_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        self._payload_size = max_datagram - FRAGMENT_HEADER.size # Frame bytes per datagram
+        self._fd = self.udp_socket.fileno()
+        self._batch = _DatagramBatch(self.udp_socket) if _sendmmsg is not None and _send_frame_compiled is None else None
+        self._header = bytearray(FRAGMENT_HEADER.size) # Reused for each fragment when sending without the batch
+        self.multicast_interface = multicast_interface
 
         self.target_ip = None
         self.target_port = None
+        self._addr = None # Resolved (ip, port) of the target
         self.running = False
-        self._stream_thread = None
-        logging.info("VideoStreamer initialized.")
-
-    def _stream_worker(self):
-        """Worker function that runs in its own thread."""
-        logging.info("Starting video recording and streaming worker...")
-        self.picam2.start_recording(self.encoder, FileOutput(self.output))
-
-        while self.running:
-            with self.output.condition:
-                # Wait for a new frame or until notified to stop
-                self.output.condition.wait()
-                if not self.running:  # Check again after waking up
-                    break
-                frame = self.output.frame
-
-            if frame and self.target_ip and self.target_port:
-                if len(frame) > MAX_UDP_PACKET_SIZE:
-                    logging.warning(f"Frame size ({len(frame)}) exceeds max UDP size ({MAX_UDP_PACKET_SIZE}). Skipping.")
-                    continue # Skip this frame
+        self._frame_id = 0
+        self.skipped_frames = 0 # Frames not sent to save bandwidth
+        self.dropped_frames = 0 # Frames (partly) lost because the kernel send buffer was full
+        self._send_errors = 0 # Failed sends, counted to rate limit their logging
+
+        # Rate adaptation: backpressure halves quality_scale, each quiet interval raises it by a tenth.
+        # The software encoder's quality follows it directly. The hardware encoder's bitrate is fixed
+        # while recording, so with it the same fraction of frames is sent instead.
+        self.quality_scale = 1.0
+        self._throttle_frames = not isinstance(self.encoder, JpegEncoder)
+        self._send_credit = 0.0 # Frames that may be sent, accumulated at quality_scale per frame
+        self._next_decrease = 0.0
+        self._next_increase = 0.0
+        self._outq = bytearray(4) # SIOCOUTQ result
+        log.info("VideoStreamer initialized.")
+
+    def _create_encoder(self, hardware_encoder):
+        """Creates the hardware MJPEG encoder if requested and available, otherwise the software JPEG encoder."""
+        if hardware_encoder:
+            try:
+                encoder = MJPEGEncoder(bitrate=self.bitrate)
+                log.info("Using hardware MJPEG encoder.")
+                return encoder
+            except Exception as e: # e.g. no hardware encoder device on this Pi
+                log.warning("Hardware MJPEG encoder unavailable (%s), falling back to software JPEG encoding.", e)
+        return JpegEncoder(q=self.jpeg_quality)
+
+    def _on_frame(self, frame):
+        """Sends a frame from the encoder. Runs on picamera2's encoder thread, so must never raise."""
+        # picamera2's encoders hand over a new bytes object for every frame and never touch it
+        # again, so sending straight from it is safe and copies nothing. Any other buffer could be
+        # reused or changed by its owner while we send it, so it is copied once here.
+        if type(frame) is not bytes:
+            frame = bytes(frame)
+        self._frame_id += 1
+
+        if self._throttle_frames:
+            self._send_credit += self.quality_scale
+            if self._send_credit < 1.0:
+                self.skipped_frames += 1
+                return
+            self._send_credit -= 1.0
+
+        congested = False
+        try:
+            self._send_frame(frame, self._frame_id)
+        except BlockingIOError:
+            self.dropped_frames += 1 # Whatever part of the frame didn't fit is lost, the client will skip it
+            congested = True
+        except OSError as e:
+            congested = e.errno == errno.ENOBUFS
+            self._log_send_error(e)
+        except Exception as e:
+            log.error("Unexpected error sending UDP frame: %s", e)
+        else:
+            congested = self._send_queue_bytes() > CONGESTED_QUEUE
+        self._adapt_rate(congested)
+
+    def _send_queue_bytes(self):
+        """Returns how many bytes are still waiting in the socket's kernel send queue, or 0 if it can't be queried."""
+        if SIOCOUTQ is None:
+            return 0
+        try:
+            fcntl.ioctl(self._fd, SIOCOUTQ, self._outq)
+        except OSError:
+            return 0 # Not a send error, the frame went out
+        return int.from_bytes(self._outq, sys.byteorder)
+
+    def _adapt_rate(self, congested):
+        """Adjusts quality_scale: halved on backpressure, then raised by a tenth for each interval without any."""
+        now = time.monotonic()
+        if congested:
+            self._next_increase = now + INCREASE_INTERVAL
+            if now < self._next_decrease or self.quality_scale <= MIN_QUALITY_SCALE:
+                return
+            self._next_decrease = now + DECREASE_HOLDOFF
+            self.quality_scale = max(MIN_QUALITY_SCALE, self.quality_scale / 2)
+        elif now >= self._next_increase and self.quality_scale < 1.0:
+            self._next_increase = now + INCREASE_INTERVAL
+            self.quality_scale = min(1.0, self.quality_scale + 0.1)
+        else:
+            return
 
-                try:
-                    self.udp_socket.sendto(frame, (self.target_ip, self.target_port))
-                except OSError as e:
-                    logging.error(f"UDP send error: {e}")
-                    # Consider stopping or pausing if errors persist
-                except Exception as e:
-                    logging.error(f"Unexpected error sending UDP frame: {e}")
+        if not self._throttle_frames:
+            self.encoder.q = max(1, round(self.jpeg_quality * self.quality_scale)) # Read by the encoder for each frame
+        log.info("Network backpressure %s, video quality now %d%%.", "rising" if congested else "easing", round(self.quality_scale * 100))
+
+    def _log_send_error(self, e):
+        """Logs a failed send, but only the first and then every SEND_ERROR_LOG_EVERY-th, so an outage doesn't flood the log."""
+        self._send_errors += 1
+        if self._send_errors % SEND_ERROR_LOG_EVERY != 1:
+            return
+        if e.errno == errno.EMSGSIZE:
+            log.error("UDP send error: %s. Lower max_datagram below the path MTU to %s.", e, self.target_ip)
+        else:
+            log.error("UDP send error (%d so far): %s", self._send_errors, e)
+
+    @staticmethod
+    def _tune_sender_thread():
+        """
+        Pins the calling thread (the encoder thread that sends frames) to the last CPU it may run on
+        and raises its priority, so sends aren't delayed by other tasks or by moving between cores.
+        Linux only, where both apply per thread.
+        """
+        if not sys.platform.startswith('linux'):
+            return
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) > 1:
+            os.sched_setaffinity(0, {cpus[-1]})
+            log.debug("Sender thread pinned to CPU %d.", cpus[-1])
+        try:
+            os.nice(SENDER_NICE)
+        except OSError: # Raising priority needs privileges
+            log.debug("No permission to raise the sender thread's priority.")
+
+    def _send_frame(self, frame, frame_id):
+        """Sends a frame to the target as fragment datagrams, batched into as few system calls as possible."""
+        if len(frame) == 0:
+            return # No fragments to send
+        payload_size = self._payload_size
+        frame_id &= 0xFFFFFFFF # Wraps around after 2**32 frames
+        if _send_frame_compiled is not None:
+            _send_frame_compiled(self._fd, frame, frame_id, payload_size)
+            return
 
-        logging.info("Stopping video recording...")
-        self.picam2.stop_recording()
-        logging.info("Streaming worker finished.")
+        count = (len(frame) + payload_size - 1) // payload_size
+        if self._batch is not None:
+            self._batch.send(frame, frame_id, count, payload_size)
+        else:
+            # Header and payload are handed to the kernel separately, so neither is copied here.
+            # The kernel has copied both by the time sendmsg returns, so one header buffer serves every fragment.
+            header = self._header
+            view = memoryview(frame)
+            for i in range(count):
+                FRAGMENT_HEADER.pack_into(header, 0, frame_id, i, count)
+                self.udp_socket.sendmsg([header, view[i * payload_size:(i + 1) * payload_size]])
 
     def start(self, target_ip, target_port):
-        """Starts the video streaming thread."""
+        """Starts recording, with each frame sent to the target as the encoder produces it."""
         if self.running:
-            logging.warning("Streamer is already running.")
+            log.warning("Streamer is already running.")
             return
 
         if not target_ip or not target_port:
-            logging.error("Target IP and Port must be set to start streaming.")
+            log.error("Target IP and Port must be set to start streaming.")
+            return
+
+        # Resolve the target once, then connect to fix the destination, rather than passing
+        # (and routing) it with every send
+        try:
+            self._addr = socket.getaddrinfo(target_ip, int(target_port), socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+            if ipaddress.IPv4Address(self._addr[0]).is_multicast:
+                self._configure_multicast()
+            self.udp_socket.connect(self._addr)
+        except OSError as e:
+            log.error("Cannot stream to %s:%s: %s", target_ip, target_port, e)
             return
 
         self.target_ip = target_ip
         self.target_port = int(target_port) # Ensure port is integer
+
+        # Start each session at full quality, whatever the last one backed off to
+        self.quality_scale = 1.0
+        self._send_credit = 0.0
+        self._next_decrease = 0.0
+        self._next_increase = 0.0
+        if not self._throttle_frames:
+            self.encoder.q = self.jpeg_quality
         self.running = True
 
-        self._stream_thread = threading.Thread(target=self._stream_worker, name="UDPStreamThread", daemon=True)
-        self._stream_thread.start()
-        logging.info(f"Video streaming started, sending to {self.target_ip}:{self.target_port}")
+        log.info("Starting video recording...")
+        try:
+            self.picam2.start_recording(self.encoder, UDPOutput(self))
+        except Exception as e:
+            log.error("Failed to start recording: %s", e)
+            self.running = False
+            return
+        log.info("Video streaming started, sending to %s:%s", self.target_ip, self.target_port)
+
+    def _configure_multicast(self):
+        """
+        Prepares the socket for sending to a multicast group. Sends are unchanged: every viewer that
+        has joined the group receives each datagram, copied by the switch rather than sent once per viewer.
+        """
+        self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', MULTICAST_TTL))
+        if self.multicast_interface:
+            self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.multicast_interface))
+        log.info("Streaming to multicast group %s, viewers must join it to receive video.", self._addr[0])
 
     def stop(self):
-        """Stops the video streaming thread."""
+        """Stops recording, and with it streaming."""
         if not self.running:
-            logging.warning("Streamer is not running.")
+            log.warning("Streamer is not running.")
             return
 
-        logging.info("Stopping video streamer...")
+        log.info("Stopping video streamer...")
         self.running = False
-
-        # Notify the waiting thread to wake up and check the 'running' flag
-        with self.output.condition:
-            self.output.condition.notify_all()
-
-        if self._stream_thread:
-            self._stream_thread.join(timeout=5) # Wait for thread to finish
-            if self._stream_thread.is_alive():
-                logging.warning("Streaming thread did not stop gracefully.")
+        self.picam2.stop_recording() # Returns once the encoder has output its last frame
 
         self.target_ip = None
         self.target_port = None
-        logging.info("Video streamer stopped.")
+        self._addr = None
+        log.info("Video streamer stopped.")
 
     def close(self):
         """Releases all resources."""
         self.stop() # Ensure it's stopped
         self.udp_socket.close()
         self.picam2.close()
-        logging.info("VideoStreamer resources released.")
+        log.info("VideoStreamer resources released.")
 
     def __del__(self):
         """Attempt to clean up resources when the object is deleted."""
@@ -171,8 +488,10 @@ if __name__ == "__main__":
             while receiver_running:
                 try:
                     data, addr = sock.recvfrom(MAX_UDP_PACKET_SIZE + 100)
-                    frame_count += 1
-                    print(f"\rReceived frame {frame_count} ({len(data)} bytes)", end="")
+                    frame_id, index, count = FRAGMENT_HEADER.unpack_from(data)
+                    if index == count - 1: # Last fragment of a frame
+                        frame_count += 1
+                        print(f"\rReceived frame {frame_count} ({count} fragments)", end="")
                 except socket.timeout:
                     continue # Just check the running flag again
         except Exception as e:
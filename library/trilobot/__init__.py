@@ -443,6 +443,20 @@ class Trilobot():
         """
         self.fill_underlighting(0, 0, 0, show=show)
 
+    def set_underlighting_batch(self, colors, show=True):
+        """ Sets the colors of all underlights at once from a flat sequence of RGB values.
+        colors: a bytes/bytearray, list or tuple of 18 numbers from 0 to 255, being the R, G and B components of underlight 0, then underlight 1, and so on
+        show: whether or not to show the new colors immediately
+        """
+        values = bytearray(colors)
+        if len(values) != NUM_UNDERLIGHTS * 3:
+            raise ValueError("colors must contain 18 values, the R, G and B components for each of the 6 underlights")
+
+        self.underlight[:] = list(values)
+
+        if show:
+            self.show_underlighting()
+
     #########################
     # Underlighting Helpers #
     #########################